@@ -3,31 +3,77 @@
 # Licensed under the MIT License.
 # ------------------------------------
 
-from datetime import datetime
-import json
-import os
-import re
-import shutil
-import subprocess
-import sys
-from typing import Any, Dict, List, Optional
+import calendar
+from concurrent.futures import Future
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 
 from azure.core.credentials import AccessToken
-from azure.core.exceptions import ClientAuthenticationError
 
-from .. import CredentialUnavailableError
-from .._internal import resolve_tenant
+from .._internal import cli_credential_base
+from .._internal.cli_credential_base import CliCredentialBase
 from .._internal.decorators import log_get_token
 
 CLI_NOT_FOUND = 'Azure Developer CLI could not be found. '\
                  'Please visit https://aka.ms/azure-dev for installation instructions and then,'\
                  'once installed, authenticate to your Azure account using \'azd auth login\'.'
-COMMAND_LINE = "azd auth token --output json --scope {}"
+COMMAND_LINE = ("auth", "token", "--output", "json")
 EXECUTABLE_NAME = "azd"
 NOT_LOGGED_IN = "Please run 'azd auth login' from a command prompt to authenticate before using this credential."
 
 
-class AzureDeveloperCliCredential:
+def parse_token(output):
+    """Parse to an AccessToken.
+
+    In particular, convert the "expiresOn" value to epoch seconds. This value is a UTC datetime in the form
+    "%Y-%m-%dT%H:%M:%SZ".
+    """
+    try:
+        token = cli_credential_base._loads(output)
+
+        # the fixed layout means the fields can be sliced out directly; this is considerably faster than
+        # datetime.strptime
+        expires_on_str = token["expiresOn"]
+        expires_on = calendar.timegm(
+            (
+                int(expires_on_str[0:4]),
+                int(expires_on_str[5:7]),
+                int(expires_on_str[8:10]),
+                int(expires_on_str[11:13]),
+                int(expires_on_str[14:16]),
+                int(expires_on_str[17:19]),
+                0,
+                0,
+                0,
+            )
+        )
+
+        return AccessToken(token["token"], expires_on)
+    except (KeyError, ValueError):
+        return None
+
+
+def get_safe_working_dir():
+    """Invoke 'azd' from a directory controlled by the OS, not the executing program's directory"""
+    return cli_credential_base.get_safe_working_dir(
+        "Azure Developer CLI credential" + " expects a 'SystemRoot' environment variable"
+    )
+
+
+def sanitize_output(output):
+    """Redact tokens from CLI output to prevent error messages revealing them"""
+    return cli_credential_base.sanitize_output(output, '"token": "')
+
+
+def _get_env() -> Dict[str, str]:
+    return cli_credential_base.get_env("NO_COLOR")
+
+
+def _resolve_executable(path_env: Optional[str], pathext_env: Optional[str]) -> Optional[str]:
+    return cli_credential_base.resolve_executable(EXECUTABLE_NAME, path_env, pathext_env)
+
+
+class AzureDeveloperCliCredential(CliCredentialBase):
     """Authenticates by requesting a token from the Azure Developer CLI.
 
     Azure Developer CLI is a command-line interface tool that allows developers to create, manage, and deploy
@@ -56,6 +102,13 @@ class AzureDeveloperCliCredential:
         acquire tokens for any tenant the application can access.
     :keyword int process_timeout: Seconds to wait for the Azure Developer CLI process to respond. Defaults
         to 10 seconds.
+    :keyword bool enable_token_caching: Whether to cache tokens in memory and reuse them until shortly before they
+        expire, instead of invoking the Azure Developer CLI for every request. Defaults to False because a cached
+        token doesn't reflect a change of the CLI's logged in identity, for example after running "azd auth login".
+    :keyword cache_persistence_options: configuration for persistent caching of the CLI's tokens, shared across
+        processes. If unspecified, tokens aren't persisted to disk. As with `enable_token_caching`, a persisted
+        token doesn't reflect a change of the CLI's logged in identity.
+    :paramtype cache_persistence_options: ~azure.identity.TokenCachePersistenceOptions
 
     .. admonition:: Example:
 
@@ -67,33 +120,26 @@ class AzureDeveloperCliCredential:
             :caption: Create an AzureDeveloperCliCredential.
     """
 
-    def __init__(
-        self,
-        *,
-        tenant_id: str = "",
-        additionally_allowed_tenants: Optional[List[str]] = None,
-        process_timeout: int = 10
-    ) -> None:
-
-        self.tenant_id = tenant_id
-        self._additionally_allowed_tenants = additionally_allowed_tenants or []
-        self._process_timeout = process_timeout
+    _EXECUTABLE_NAME = EXECUTABLE_NAME
+    _DISPLAY_NAME = "Azure Developer CLI"
+    _CLI_NOT_FOUND = CLI_NOT_FOUND
+    _NOT_LOGGED_IN = NOT_LOGGED_IN
+    _NOT_LOGGED_IN_MARKERS = (b"not logged in, run `azd auth login` to login",)
+    _SANITIZE_NEEDLE = '"token": "'
+    _NO_COLOR_VARIABLE = "NO_COLOR"
+    _SYSTEMROOT_ERROR = "Azure Developer CLI credential" + " expects a 'SystemRoot' environment variable"
+    _TROUBLESHOOTING_URL = "https://aka.ms/azsdk/python/identity/azdevclicredential/troubleshoot"
 
-    def __enter__(self) -> "AzureDeveloperCliCredential":
-        return self
+    _token_cache: Dict[Tuple, AccessToken] = {}
+    _token_cache_lock = threading.Lock()
+    _inflight: Dict[Tuple, "Future[AccessToken]"] = {}
 
-    def __exit__(self, *args: Any) -> None:
-        pass
-
-    def close(self) -> None:
-        """Calling this method is unnecessary."""
-
-    @log_get_token("AzureDeveloperCliCredential")
     def get_token(self, *scopes: str, **kwargs: Any) -> AccessToken:
         """Request an access token for `scopes`.
 
         This method is called automatically by Azure SDK clients. Applications calling this method directly must
-        also handle token caching because this credential doesn't cache the tokens it acquires.
+        also handle token caching because this credential doesn't cache the tokens it acquires unless it was
+        constructed with `enable_token_caching=True`.
 
         :param str scopes: desired scope for the access token. This credential allows only one scope per request.
             For more information about scopes, see
@@ -111,102 +157,19 @@ class AzureDeveloperCliCredential:
         if not scopes:
             raise ValueError("Missing scope in request. \n")
 
-        commandString = " --scope ".join(scopes)
-        command = COMMAND_LINE.format(commandString)
-        tenant = resolve_tenant(
-            default_tenant=self.tenant_id, additionally_allowed_tenants=self._additionally_allowed_tenants, **kwargs
-        )
-        if tenant:
-            command += " --tenant-id " + tenant
-        output = _run_command(command, self._process_timeout)
-
-        token = parse_token(output)
-        if not token:
-            sanitized_output = sanitize_output(output)
-            raise ClientAuthenticationError(
-                message="Unexpected output from Azure CLI: '{}'. \n"
-                        "To mitigate this issue, please refer to the troubleshooting guidelines here at "
-                        "https://aka.ms/azsdk/python/identity/azdevclicredential/troubleshoot.".format(sanitized_output)
-            )
-
-        return token
-
-
-def parse_token(output):
-    """Parse to an AccessToken.
-
-    In particular, convert the "expiresOn" value to epoch seconds. This value is a naive local datetime as returned by
-    datetime.fromtimestamp.
-    """
-    try:
-        token = json.loads(output)
-        dt = datetime.strptime(token["expiresOn"], "%Y-%m-%dT%H:%M:%SZ")
-        expires_on = dt.timestamp()
-
-        return AccessToken(token["token"], int(expires_on))
-    except (KeyError, ValueError):
-        return None
-
-
-def get_safe_working_dir():
-    """Invoke 'azd' from a directory controlled by the OS, not the executing program's directory"""
-
-    if sys.platform.startswith("win"):
-        path = os.environ.get("SYSTEMROOT")
-        if not path:
-            raise CredentialUnavailableError(
-                message="Azure Developer CLI credential" + " expects a 'SystemRoot' environment variable"
-            )
-        return path
-
-    return "/bin"
-
-
-def sanitize_output(output):
-    """Redact tokens from CLI output to prevent error messages revealing them"""
-    return re.sub(r"\"token\": \"(.*?)(\"|$)", "****", output)
+        # a cached token requires no logging or CLI invocation; return it without entering the decorated path
+        return self._cached_token(scopes, kwargs) or self._acquire_token(scopes, kwargs)
 
+    @log_get_token("AzureDeveloperCliCredential")
+    def _acquire_token(self, scopes: Tuple[str, ...], kwargs: Dict[str, Any]) -> AccessToken:
+        return self._get_token_base(scopes, kwargs)
 
-def _run_command(command: str, timeout: int) -> str:
-    # Ensure executable exists in PATH first. This avoids a subprocess call that would fail anyway.
-    if shutil.which(EXECUTABLE_NAME) is None:
-        raise CredentialUnavailableError(message=CLI_NOT_FOUND)
+    def _build_command(self, scopes: Tuple[str, ...], tenant: str) -> List[str]:
+        command = list(COMMAND_LINE)
+        for scope in scopes:
+            command.extend(("--scope", scope))
+        if tenant:
+            command.extend(("--tenant-id", tenant))
+        return command
 
-    if sys.platform.startswith("win"):
-        args = ["cmd", "/c", command]
-    else:
-        args = ["/bin/sh", "-c", command]
-    try:
-        working_directory = get_safe_working_dir()
-
-        kwargs: Dict[str, Any] = {
-            "stderr": subprocess.PIPE,
-            "cwd": working_directory,
-            "universal_newlines": True,
-            "env": dict(os.environ, NO_COLOR="true"),
-            "timeout": timeout,
-        }
-
-        return subprocess.check_output(args, **kwargs)
-    except subprocess.CalledProcessError as ex:
-        # non-zero return from shell
-        # Fallback check in case the executable is not found while executing subprocess.
-        if ex.returncode == 127 or ex.stderr.startswith("'azd' is not recognized"):
-            raise CredentialUnavailableError(message=CLI_NOT_FOUND)
-        if "not logged in, run `azd auth login` to login" in ex.stderr:
-            raise CredentialUnavailableError(message=NOT_LOGGED_IN)
-
-        # return code is from the CLI -> propagate its output
-        if ex.stderr:
-            message = sanitize_output(ex.stderr)
-        else:
-            message = "Failed to invoke Azure Developer CLI"
-        raise ClientAuthenticationError(message=message)
-    except OSError as ex:
-        # failed to execute 'cmd' or '/bin/sh'
-        error = CredentialUnavailableError(message="Failed to execute '{}'".format(args[0]))
-        raise error from ex
-    except Exception as ex:  # pylint:disable=broad-except
-        # could be a timeout, for example
-        error = CredentialUnavailableError(message="Failed to invoke the Azure Developer CLI")
-        raise error from ex
+    _parse_token = staticmethod(parse_token)
@@ -2,31 +2,76 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 # ------------------------------------
-from datetime import datetime
-import json
-import os
-import re
-import shutil
-import subprocess
-import sys
+from concurrent.futures import Future
+import threading
 import time
-from typing import List, Optional, Any, Dict
+from typing import List, Optional, Any, Dict, Tuple
 
 from azure.core.credentials import AccessToken
-from azure.core.exceptions import ClientAuthenticationError
 
-from .. import CredentialUnavailableError
-from .._internal import _scopes_to_resource, resolve_tenant
+from .._internal import _scopes_to_resource
+from .._internal import cli_credential_base
+from .._internal.cli_credential_base import CliCredentialBase
 from .._internal.decorators import log_get_token
 
 
 CLI_NOT_FOUND = "Azure CLI not found on path"
-COMMAND_LINE = "az account get-access-token --output json --resource {}"
+COMMAND_LINE = ("account", "get-access-token", "--output", "json", "--resource")
 EXECUTABLE_NAME = "az"
 NOT_LOGGED_IN = "Please run 'az login' to set up an account"
 
 
-class AzureCliCredential:
+def parse_token(output) -> Optional[AccessToken]:
+    """Parse output of 'az account get-access-token' to an AccessToken.
+
+    In particular, convert the "expiresOn" value to epoch seconds. This value is a naive local datetime as returned by
+    datetime.fromtimestamp.
+    """
+    try:
+        token = cli_credential_base._loads(output)
+
+        # "expiresOn" has the fixed layout "%Y-%m-%d %H:%M:%S.%f", so the fields can be sliced out directly; this is
+        # considerably faster than datetime.strptime. Fractional seconds are ignored because the expiry is truncated
+        # to whole seconds anyway.
+        expires_on_str = token["expiresOn"]
+        expires_on = time.mktime(
+            (
+                int(expires_on_str[0:4]),
+                int(expires_on_str[5:7]),
+                int(expires_on_str[8:10]),
+                int(expires_on_str[11:13]),
+                int(expires_on_str[14:16]),
+                int(expires_on_str[17:19]),
+                0,
+                0,
+                -1,
+            )
+        )
+
+        return AccessToken(token["accessToken"], int(expires_on))
+    except (KeyError, ValueError):
+        return None
+
+
+def get_safe_working_dir() -> str:
+    """Invoke 'az' from a directory controlled by the OS, not the executing program's directory"""
+    return cli_credential_base.get_safe_working_dir("Environment variable 'SYSTEMROOT' has no value")
+
+
+def sanitize_output(output: str) -> str:
+    """Redact access tokens from CLI output to prevent error messages revealing them"""
+    return cli_credential_base.sanitize_output(output, '"accessToken": "')
+
+
+def _get_env() -> Dict[str, str]:
+    return cli_credential_base.get_env("AZURE_CORE_NO_COLOR")
+
+
+def _resolve_executable(path_env: Optional[str], pathext_env: Optional[str]) -> Optional[str]:
+    return cli_credential_base.resolve_executable(EXECUTABLE_NAME, path_env, pathext_env)
+
+
+class AzureCliCredential(CliCredentialBase):
     """Authenticates by requesting a token from the Azure CLI.
 
     This requires previously logging in to Azure via "az login", and will use the CLI's currently logged in identity.
@@ -36,6 +81,13 @@ class AzureCliCredential:
         for which the credential may acquire tokens. Add the wildcard value "*" to allow the credential to
         acquire tokens for any tenant the application can access.
     :keyword int process_timeout: Seconds to wait for the Azure CLI process to respond. Defaults to 10 seconds.
+    :keyword bool enable_token_caching: Whether to cache tokens in memory and reuse them until shortly before they
+        expire, instead of invoking the Azure CLI for every request. Defaults to False because a cached token doesn't
+        reflect a change of the CLI's logged in identity, for example after running "az login" or "az account set".
+    :keyword cache_persistence_options: configuration for persistent caching of the CLI's tokens, shared across
+        processes. If unspecified, tokens aren't persisted to disk. As with `enable_token_caching`, a persisted
+        token doesn't reflect a change of the CLI's logged in identity.
+    :paramtype cache_persistence_options: ~azure.identity.TokenCachePersistenceOptions
 
     .. admonition:: Example:
 
@@ -46,33 +98,27 @@ class AzureCliCredential:
             :dedent: 4
             :caption: Create an AzureCliCredential.
     """
-    def __init__(
-        self,
-        *,
-        tenant_id: str = "",
-        additionally_allowed_tenants: Optional[List[str]] = None,
-        process_timeout: int = 10
-    ) -> None:
-
-        self.tenant_id = tenant_id
-        self._additionally_allowed_tenants = additionally_allowed_tenants or []
-        self._process_timeout = process_timeout
 
-    def __enter__(self):
-        return self
+    _EXECUTABLE_NAME = EXECUTABLE_NAME
+    _DISPLAY_NAME = "Azure CLI"
+    _CLI_NOT_FOUND = CLI_NOT_FOUND
+    _NOT_LOGGED_IN = NOT_LOGGED_IN
+    _NOT_LOGGED_IN_MARKERS = (b"az login", b"az account set")
+    _SANITIZE_NEEDLE = '"accessToken": "'
+    _NO_COLOR_VARIABLE = "AZURE_CORE_NO_COLOR"
+    _SYSTEMROOT_ERROR = "Environment variable 'SYSTEMROOT' has no value"
+    _TROUBLESHOOTING_URL = "https://aka.ms/azsdk/python/identity/azclicredential/troubleshoot"
 
-    def __exit__(self, *args):
-        pass
+    _token_cache: Dict[Tuple, AccessToken] = {}
+    _token_cache_lock = threading.Lock()
+    _inflight: Dict[Tuple, "Future[AccessToken]"] = {}
 
-    def close(self) -> None:
-        """Calling this method is unnecessary."""
-
-    @log_get_token("AzureCliCredential")
     def get_token(self, *scopes: str, **kwargs: Any) -> AccessToken:
         """Request an access token for `scopes`.
 
         This method is called automatically by Azure SDK clients. Applications calling this method directly must
-        also handle token caching because this credential doesn't cache the tokens it acquires.
+        also handle token caching because this credential doesn't cache the tokens it acquires unless it was
+        constructed with `enable_token_caching=True`.
 
         :param str scopes: desired scope for the access token. This credential allows only one scope per request.
             For more information about scopes, see
@@ -85,106 +131,18 @@ class AzureCliCredential:
         :raises ~azure.core.exceptions.ClientAuthenticationError: the credential invoked the Azure CLI but didn't
           receive an access token.
         """
+        # a cached token requires no logging or CLI invocation; return it without entering the decorated path
+        return self._cached_token(scopes, kwargs) or self._acquire_token(scopes, kwargs)
+
+    @log_get_token("AzureCliCredential")
+    def _acquire_token(self, scopes: Tuple[str, ...], kwargs: Dict[str, Any]) -> AccessToken:
+        return self._get_token_base(scopes, kwargs)
 
+    def _build_command(self, scopes: Tuple[str, ...], tenant: str) -> List[str]:
         resource = _scopes_to_resource(*scopes)
-        command = COMMAND_LINE.format(resource)
-        tenant = resolve_tenant(
-            default_tenant=self.tenant_id,
-            additionally_allowed_tenants=self._additionally_allowed_tenants,
-            **kwargs
-        )
+        command = [*COMMAND_LINE, resource]
         if tenant:
-            command += " --tenant " + tenant
-        output = _run_command(command, self._process_timeout)
-
-        token = parse_token(output)
-        if not token:
-            sanitized_output = sanitize_output(output)
-            raise ClientAuthenticationError(
-                message="Unexpected output from Azure CLI: '{}'. \n"
-                        "To mitigate this issue, please refer to the troubleshooting guidelines here at "
-                        "https://aka.ms/azsdk/python/identity/azclicredential/troubleshoot.".format(sanitized_output))
-
-        return token
-
-
-def parse_token(output) -> Optional[AccessToken]:
-    """Parse output of 'az account get-access-token' to an AccessToken.
-
-    In particular, convert the "expiresOn" value to epoch seconds. This value is a naive local datetime as returned by
-    datetime.fromtimestamp.
-    """
-    try:
-        token = json.loads(output)
-        dt = datetime.strptime(token["expiresOn"], "%Y-%m-%d %H:%M:%S.%f")
-        if hasattr(dt, "timestamp"):
-            # Python >= 3.3
-            expires_on = dt.timestamp()
-        else:
-            # taken from Python 3.5's datetime.timestamp()
-            expires_on = time.mktime((dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, -1, -1, -1))
-
-        return AccessToken(token["accessToken"], int(expires_on))
-    except (KeyError, ValueError):
-        return None
-
-
-def get_safe_working_dir() -> str:
-    """Invoke 'az' from a directory controlled by the OS, not the executing program's directory"""
-
-    if sys.platform.startswith("win"):
-        path = os.environ.get("SYSTEMROOT")
-        if not path:
-            raise CredentialUnavailableError(message="Environment variable 'SYSTEMROOT' has no value")
-        return path
-
-    return "/bin"
+            command.extend(("--tenant", tenant))
+        return command
 
-
-def sanitize_output(output: str) -> str:
-    """Redact access tokens from CLI output to prevent error messages revealing them"""
-    return re.sub(r"\"accessToken\": \"(.*?)(\"|$)", "****", output)
-
-
-def _run_command(command: str, timeout: int) -> str:
-    # Ensure executable exists in PATH first. This avoids a subprocess call that would fail anyway.
-    if shutil.which(EXECUTABLE_NAME) is None:
-        raise CredentialUnavailableError(message=CLI_NOT_FOUND)
-
-    if sys.platform.startswith("win"):
-        args = ["cmd", "/c", command]
-    else:
-        args = ["/bin/sh", "-c", command]
-    try:
-        working_directory = get_safe_working_dir()
-
-        kwargs: Dict[str, Any] = {
-            "stderr": subprocess.PIPE,
-            "cwd": working_directory,
-            "universal_newlines": True,
-            "timeout": timeout,
-            "env": dict(os.environ, AZURE_CORE_NO_COLOR="true"),
-        }
-        return subprocess.check_output(args, **kwargs)
-    except subprocess.CalledProcessError as ex:
-        # non-zero return from shell
-        # Fallback check in case the executable is not found while executing subprocess.
-        if ex.returncode == 127 or ex.stderr.startswith("'az' is not recognized"):
-            raise CredentialUnavailableError(message=CLI_NOT_FOUND)
-        if "az login" in ex.stderr or "az account set" in ex.stderr:
-            raise CredentialUnavailableError(message=NOT_LOGGED_IN)
-
-        # return code is from the CLI -> propagate its output
-        if ex.stderr:
-            message = sanitize_output(ex.stderr)
-        else:
-            message = "Failed to invoke Azure CLI"
-        raise ClientAuthenticationError(message=message)
-    except OSError as ex:
-        # failed to execute 'cmd' or '/bin/sh'
-        error = CredentialUnavailableError(message="Failed to execute '{}'".format(args[0]))
-        raise error from ex
-    except Exception as ex:  # pylint:disable=broad-except
-        # could be a timeout, for example
-        error = CredentialUnavailableError(message="Failed to invoke the Azure CLI")
-        raise error from ex
+    _parse_token = staticmethod(parse_token)
@@ -0,0 +1,288 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+import abc
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+import functools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import ClientAuthenticationError
+
+from . import resolve_tenant
+from .cli_token_cache import CliTokenCache
+from .._constants import DEFAULT_REFRESH_OFFSET
+from .._exceptions import CredentialUnavailableError
+from .._persistent_cache import TokenCachePersistenceOptions
+
+try:
+    # orjson parses the CLI's JSON output several times faster than the standard library; it's optional, so fall
+    # back to json when it isn't installed
+    from orjson import loads as _loads  # pylint:disable=unused-import
+except ImportError:
+    _loads = json.loads
+
+
+class CliCredentialBase(abc.ABC):
+    """Shared implementation for credentials which invoke a command line tool to acquire tokens.
+
+    Subclasses parameterize this class through attributes naming the executable and its messages, and implement
+    :func:`_build_command` and :func:`_parse_token` for the tool's arguments and output format. They must also
+    define their own ``_token_cache``, ``_token_cache_lock`` and ``_inflight`` class attributes so tokens from
+    different tools are never mixed.
+    """
+
+    _EXECUTABLE_NAME: str
+    _DISPLAY_NAME: str
+    _CLI_NOT_FOUND: str
+    _NOT_LOGGED_IN: str
+    _NOT_LOGGED_IN_MARKERS: Tuple[bytes, ...]
+    _SANITIZE_NEEDLE: str
+    _NO_COLOR_VARIABLE: str
+    _SYSTEMROOT_ERROR: str
+    _TROUBLESHOOTING_URL: str
+
+    _token_cache: Dict[Tuple, AccessToken]
+    _token_cache_lock: threading.Lock
+    _inflight: Dict[Tuple, "Future[AccessToken]"]
+
+    def __init__(
+        self,
+        *,
+        tenant_id: str = "",
+        additionally_allowed_tenants: Optional[List[str]] = None,
+        process_timeout: int = 10,
+        enable_token_caching: bool = False,
+        cache_persistence_options: Optional[TokenCachePersistenceOptions] = None
+    ) -> None:
+
+        self.tenant_id = tenant_id
+        self._additionally_allowed_tenants = additionally_allowed_tenants or []
+        self._process_timeout = process_timeout
+        self._enable_token_caching = enable_token_caching
+        self._persistent_cache: Optional[CliTokenCache] = (
+            CliTokenCache(self._EXECUTABLE_NAME, cache_persistence_options) if cache_persistence_options else None
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self) -> None:
+        """Calling this method is unnecessary."""
+
+    @abc.abstractmethod
+    def _build_command(self, scopes: Tuple[str, ...], tenant: str) -> List[str]:
+        """Return the CLI's arguments for a token request for `scopes` and `tenant`"""
+
+    @staticmethod
+    @abc.abstractmethod
+    def _parse_token(output: str) -> Optional[AccessToken]:
+        """Parse the CLI's output to an AccessToken, or return None when it isn't a token response"""
+
+    def _resolve_tenant(self, kwargs: Dict[str, Any]) -> str:
+        if self.tenant_id or kwargs.get("tenant_id"):
+            return resolve_tenant(
+                default_tenant=self.tenant_id,
+                additionally_allowed_tenants=self._additionally_allowed_tenants,
+                **kwargs
+            )
+        # resolve_tenant returns "" when neither the credential nor the request specifies a tenant; skip its
+        # validation on this common path
+        return ""
+
+    def _load_cached_token(self, cache_key: Tuple) -> Optional[AccessToken]:
+        cls = type(self)
+        if self._enable_token_caching:
+            with cls._token_cache_lock:
+                cached_token = cls._token_cache.get(cache_key)
+            if cached_token and cached_token.expires_on - int(time.time()) > DEFAULT_REFRESH_OFFSET:
+                return cached_token
+        if self._persistent_cache:
+            cached_token = self._persistent_cache.load_token(cache_key)
+            if cached_token and cached_token.expires_on - int(time.time()) > DEFAULT_REFRESH_OFFSET:
+                return cached_token
+        return None
+
+    def _cached_token(self, scopes: Tuple[str, ...], kwargs: Dict[str, Any]) -> Optional[AccessToken]:
+        """Return a valid cached token, letting get_token skip the logged acquisition path entirely"""
+        if not (self._enable_token_caching or self._persistent_cache):
+            return None
+        tenant = self._resolve_tenant(kwargs)
+        return self._load_cached_token((scopes, tenant, kwargs.get("claims")))
+
+    def _get_token_base(self, scopes: Tuple[str, ...], kwargs: Dict[str, Any]) -> AccessToken:
+        cls = type(self)
+        tenant = self._resolve_tenant(kwargs)
+        cache_key = (scopes, tenant, kwargs.get("claims"))
+        cached_token = self._load_cached_token(cache_key)
+        if cached_token:
+            return cached_token
+
+        with cls._token_cache_lock:
+            in_flight = cls._inflight.get(cache_key)
+            if in_flight is None:
+                future: "Future[AccessToken]" = Future()
+                cls._inflight[cache_key] = future
+        if in_flight is not None:
+            # another thread is already invoking the CLI for this key; share its result instead of spawning a
+            # redundant process
+            try:
+                return in_flight.result(timeout=self._process_timeout + 5)
+            except FuturesTimeoutError as ex:
+                error = CredentialUnavailableError(message="Timed out waiting for the " + cls._DISPLAY_NAME)
+                raise error from ex
+
+        try:
+            command = self._build_command(scopes, tenant)
+            output = self._run_command(command, self._process_timeout)
+
+            token = self._parse_token(output)
+            if not token:
+                sanitized_output = sanitize_output(output, cls._SANITIZE_NEEDLE)
+                raise ClientAuthenticationError(
+                    message="Unexpected output from Azure CLI: '{}'. \n"
+                            "To mitigate this issue, please refer to the troubleshooting guidelines here at "
+                            "{}.".format(sanitized_output, cls._TROUBLESHOOTING_URL))
+        except Exception as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(token)
+        finally:
+            with cls._token_cache_lock:
+                cls._inflight.pop(cache_key, None)
+
+        if self._enable_token_caching:
+            with cls._token_cache_lock:
+                cls._token_cache[cache_key] = token
+        if self._persistent_cache:
+            self._persistent_cache.save_token(cache_key, token)
+
+        return token
+
+    @classmethod
+    def _run_command(cls, command: List[str], timeout: int) -> str:
+        # Ensure executable exists in PATH first. This avoids a subprocess call that would fail anyway.
+        cli_path = resolve_executable(cls._EXECUTABLE_NAME, os.environ.get("PATH"), os.environ.get("PATHEXT"))
+        if not cli_path:
+            raise CredentialUnavailableError(message=cls._CLI_NOT_FOUND)
+
+        # execute the CLI directly rather than through a shell; the command is built entirely from trusted strings
+        args = [cli_path, *command]
+        try:
+            working_directory = get_safe_working_dir(cls._SYSTEMROOT_ERROR)
+
+            kwargs: Dict[str, Any] = {
+                "stdout": subprocess.PIPE,
+                "stderr": subprocess.PIPE,
+                "cwd": working_directory,
+                "env": get_env(cls._NO_COLOR_VARIABLE),
+                # the token JSON is well under this size; a single sized read collects it without the generic
+                # small-buffer loop of subprocess.check_output
+                "bufsize": 8192,
+            }
+            if sys.platform.startswith("win"):
+                kwargs["creationflags"] = subprocess.CREATE_NO_WINDOW
+
+            proc = subprocess.Popen(args, **kwargs)  # pylint:disable=consider-using-with
+            try:
+                stdout, stderr = proc.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                raise
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, args, output=stdout, stderr=stderr)
+            return stdout.decode()
+        except subprocess.CalledProcessError as ex:
+            # non-zero return from the CLI
+            # Fallback check in case the executable is not found while executing subprocess.
+            if ex.returncode == 127:
+                raise CredentialUnavailableError(message=cls._CLI_NOT_FOUND)
+            # the login markers appear at the start of the CLI's error output; scanning a bounded prefix of the
+            # raw bytes classifies the failure without decoding arbitrarily long stderr
+            stderr_head = ex.stderr[:1024] if ex.stderr else b""
+            if any(marker in stderr_head for marker in cls._NOT_LOGGED_IN_MARKERS):
+                raise CredentialUnavailableError(message=cls._NOT_LOGGED_IN)
+
+            # return code is from the CLI -> propagate its output, decoded only now that it's user-facing
+            if ex.stderr:
+                message = sanitize_output(ex.stderr.decode(errors="replace"), cls._SANITIZE_NEEDLE)
+            else:
+                message = "Failed to invoke " + cls._DISPLAY_NAME
+            raise ClientAuthenticationError(message=message)
+        except OSError as ex:
+            # failed to execute the CLI
+            error = CredentialUnavailableError(message="Failed to execute '{}'".format(args[0]))
+            raise error from ex
+        except Exception as ex:  # pylint:disable=broad-except
+            # could be a timeout, for example
+            error = CredentialUnavailableError(message="Failed to invoke the " + cls._DISPLAY_NAME)
+            raise error from ex
+
+
+@functools.lru_cache(maxsize=None)
+def get_safe_working_dir(systemroot_error: str) -> str:
+    """Invoke the CLI from a directory controlled by the OS, not the executing program's directory.
+
+    The result is invariant for the life of the process, so it's memoized; lru_cache doesn't cache exceptions,
+    so a missing SYSTEMROOT still raises on every call rather than poisoning the cache.
+    """
+
+    if sys.platform.startswith("win"):
+        path = os.environ.get("SYSTEMROOT")
+        if not path:
+            raise CredentialUnavailableError(message=systemroot_error)
+        return path
+
+    return "/bin"
+
+
+def sanitize_output(output: str, needle: str) -> str:
+    """Redact access tokens introduced by `needle` from CLI output to prevent error messages revealing them"""
+    start = output.find(needle)
+    while start >= 0:
+        end = output.find('"', start + len(needle))
+        if end < 0:
+            # the token value isn't terminated; redact the rest of the output
+            return output[:start] + "****"
+        output = output[:start] + "****" + output[end + 1:]
+        start = output.find(needle, start + 4)
+    return output
+
+
+_cached_envs: Dict[str, Tuple[Tuple[int, int], Dict[str, str]]] = {}
+_cached_env_lock = threading.Lock()
+
+
+def get_env(no_color_variable: str) -> Dict[str, str]:
+    """Return the environment for CLI subprocesses, copying os.environ only when it has changed since the last call"""
+    sig = (len(os.environ), hash(frozenset(os.environ.items())))
+    cached = _cached_envs.get(no_color_variable)
+    if cached is None or cached[0] != sig:
+        with _cached_env_lock:
+            # environ.copy() reads the proxy's internal mapping once, where dict(os.environ, ...) would do a
+            # proxied lookup per key
+            env = os.environ.copy()
+            env[no_color_variable] = "true"
+            cached = (sig, env)
+            _cached_envs[no_color_variable] = cached
+    return cached[1]
+
+
+@functools.lru_cache(maxsize=8)
+def resolve_executable(executable: str, path_env: Optional[str], pathext_env: Optional[str]) -> Optional[str]:
+    """Locate the CLI on PATH. The environment arguments aren't used directly; they key the cache to the variables
+    shutil.which consults, so a stale result isn't returned after either changes."""
+    # pylint:disable=unused-argument
+    return shutil.which(executable)
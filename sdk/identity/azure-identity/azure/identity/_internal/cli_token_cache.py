@@ -0,0 +1,92 @@
+# ------------------------------------
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+# ------------------------------------
+import hashlib
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from azure.core.credentials import AccessToken
+
+from .._persistent_cache import _get_persistence, TokenCachePersistenceOptions
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class CliTokenCache:
+    """A file-backed cache of CLI access tokens, shared across processes.
+
+    The cache lets short-lived processes reuse a token acquired by an earlier process instead of invoking the CLI
+    again. It's stored in the same OS-protected location as the caches configured by
+    :class:`~azure.identity.TokenCachePersistenceOptions`, and entries are keyed by a SHA-256 hash of
+    (scopes, tenant, claims) so the file doesn't reveal what tokens an application requested.
+
+    :param str cache_name: name of the CLI owning the cache, used to isolate its file from MSAL token caches
+    :param options: user configuration for persistent caching
+    :type options: ~azure.identity.TokenCachePersistenceOptions
+    """
+
+    def __init__(self, cache_name: str, options: TokenCachePersistenceOptions) -> None:
+        self._lock = threading.Lock()
+        self._options = options
+        self._cache_name = cache_name
+        self._persistence: Optional[Any] = None
+
+    def _get_persistence(self) -> Any:
+        if self._persistence is None:
+            self._persistence = _get_persistence(
+                allow_unencrypted=self._options.allow_unencrypted_storage,
+                account_name="MSALCache",
+                cache_name="{}.{}".format(self._cache_name, self._options.name),
+            )
+        return self._persistence
+
+    @staticmethod
+    def _hash_key(key: Tuple) -> str:
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+    def _load_entries(self) -> Dict[str, Any]:
+        try:
+            content = self._get_persistence().load()
+            entries = json.loads(content) if content else {}
+            # valid JSON that isn't an object, e.g. from corruption or a foreign writer, is also a miss
+            return entries if isinstance(entries, dict) else {}
+        except Exception as ex:  # pylint:disable=broad-except
+            # the cache is empty, unreadable, or holds invalid JSON; treat all these as a miss
+            _LOGGER.debug('Failed to load persisted CLI tokens: "%s"', ex, exc_info=True)
+            return {}
+
+    def load_token(self, key: Tuple) -> Optional[AccessToken]:
+        """Return the cached token for `key`, or None. The caller is responsible for checking expiry."""
+
+        self._get_persistence()  # propagate configuration errors before attempting a read
+        with self._lock:
+            entry = self._load_entries().get(self._hash_key(key))
+        if not entry:
+            return None
+        try:
+            return AccessToken(entry["token"], int(entry["expires_on"]))
+        except (KeyError, TypeError, ValueError) as ex:
+            _LOGGER.debug('Discarding malformed CLI token cache entry: "%s"', ex, exc_info=True)
+            return None
+
+    def save_token(self, key: Tuple, token: AccessToken) -> None:
+        """Persist `token` under `key`, dropping any expired entries."""
+
+        import msal_extensions
+
+        persistence = self._get_persistence()
+        lock = msal_extensions.CrossPlatLock(persistence.get_location() + ".lockfile")
+        try:
+            with self._lock, lock:
+                entries = self._load_entries()
+                now = int(time.time())
+                entries = {k: v for k, v in entries.items() if v.get("expires_on", 0) > now}
+                entries[self._hash_key(key)] = {"token": token.token, "expires_on": token.expires_on}
+                persistence.save(json.dumps(entries))
+        except Exception as ex:  # pylint:disable=broad-except
+            # failing to persist a token shouldn't fail authentication; the next process will invoke the CLI
+            _LOGGER.debug('Failed to persist CLI token: "%s"', ex, exc_info=True)
@@ -4,9 +4,8 @@
 # ------------------------------------
 import asyncio
 import os
-import shutil
 import sys
-from typing import List, Any, Optional
+from typing import List, Any, Dict, Optional, Tuple
 
 from azure.core.exceptions import ClientAuthenticationError
 from azure.core.credentials import AccessToken
@@ -17,11 +16,12 @@ from ..._credentials.azure_cli import (
     AzureCliCredential as _SyncAzureCliCredential,
     CLI_NOT_FOUND,
     COMMAND_LINE,
-    EXECUTABLE_NAME,
     get_safe_working_dir,
     NOT_LOGGED_IN,
     parse_token,
     sanitize_output,
+    _get_env,
+    _resolve_executable,
 )
 from ..._internal import _scopes_to_resource, resolve_tenant
 
@@ -46,6 +46,9 @@ class AzureCliCredential(AsyncContextManager):
             :dedent: 4
             :caption: Create an AzureCliCredential.
     """
+
+    _inflight: Dict[Tuple, "asyncio.Future[AccessToken]"] = {}
+
     def __init__(
         self,
         *,
@@ -79,24 +82,61 @@ class AzureCliCredential(AsyncContextManager):
             return _SyncAzureCliCredential().get_token(*scopes, **kwargs)
 
         resource = _scopes_to_resource(*scopes)
-        command = COMMAND_LINE.format(resource)
-        tenant = resolve_tenant(
-            default_tenant=self.tenant_id,
-            additionally_allowed_tenants=self._additionally_allowed_tenants,
-            **kwargs
-        )
+        command = [*COMMAND_LINE, resource]
+        if self.tenant_id or kwargs.get("tenant_id"):
+            tenant = resolve_tenant(
+                default_tenant=self.tenant_id,
+                additionally_allowed_tenants=self._additionally_allowed_tenants,
+                **kwargs
+            )
+        else:
+            # resolve_tenant returns "" when neither the credential nor the request specifies a tenant; skip its
+            # validation on this common path
+            tenant = ""
 
         if tenant:
-            command += " --tenant " + tenant
-        output = await _run_command(command, self._process_timeout)
-
-        token = parse_token(output)
-        if not token:
-            sanitized_output = sanitize_output(output)
-            raise ClientAuthenticationError(
-                message="Unexpected output from Azure CLI: '{}'. \n"
-                        "To mitigate this issue, please refer to the troubleshooting guidelines here at "
-                        "https://aka.ms/azsdk/python/identity/azclicredential/troubleshoot.".format(sanitized_output))
+            command.extend(("--tenant", tenant))
+
+        loop = asyncio.get_event_loop()
+        # futures belong to one event loop, so the loop is part of the key
+        key = (id(loop), scopes, tenant, kwargs.get("claims"))
+        in_flight = AzureCliCredential._inflight.get(key)
+        if in_flight is not None:
+            # another task is already invoking the CLI for this key; share its result instead of spawning a
+            # redundant process. shield keeps one waiter's cancellation from cancelling the shared future.
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    # this task itself was cancelled
+                    raise
+                # the task running the shared invocation was cancelled before producing a result; fall through
+                # and invoke the CLI on this task's own behalf
+        future: "asyncio.Future[AccessToken]" = loop.create_future()
+        AzureCliCredential._inflight[key] = future
+
+        try:
+            output = await _run_command(command, self._process_timeout)
+
+            token = parse_token(output)
+            if not token:
+                sanitized_output = sanitize_output(output)
+                raise ClientAuthenticationError(
+                    message="Unexpected output from Azure CLI: '{}'. \n"
+                            "To mitigate this issue, please refer to the troubleshooting guidelines here at "
+                            "https://aka.ms/azsdk/python/identity/azclicredential/troubleshoot."
+                            .format(sanitized_output))
+        except Exception as ex:
+            future.set_exception(ex)
+            future.exception()  # mark retrieved so a failure with no waiters doesn't log a warning
+            raise
+        else:
+            future.set_result(token)
+        finally:
+            AzureCliCredential._inflight.pop(key, None)
+            if not future.done():
+                # this task was cancelled before resolving the future; unblock any waiters
+                future.cancel()
 
         return token
 
@@ -104,15 +144,14 @@ class AzureCliCredential(AsyncContextManager):
         """Calling this method is unnecessary"""
 
 
-async def _run_command(command: str, timeout: int) -> str:
+async def _run_command(command: List[str], timeout: int) -> str:
     # Ensure executable exists in PATH first. This avoids a subprocess call that would fail anyway.
-    if shutil.which(EXECUTABLE_NAME) is None:
+    cli_path = _resolve_executable(os.environ.get("PATH"), os.environ.get("PATHEXT"))
+    if not cli_path:
         raise CredentialUnavailableError(message=CLI_NOT_FOUND)
 
-    if sys.platform.startswith("win"):
-        args = ("cmd", "/c " + command)
-    else:
-        args = ("/bin/sh", "-c", command)
+    # execute the CLI directly rather than through a shell; the command is built entirely from trusted strings
+    args = (cli_path, *command)
 
     working_directory = get_safe_working_dir()
 
@@ -122,13 +161,13 @@ async def _run_command(command: str, timeout: int) -> str:
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
             cwd=working_directory,
-            env=dict(os.environ, AZURE_CORE_NO_COLOR="true")
+            env=_get_env()
         )
         stdout_b, stderr_b = await asyncio.wait_for(proc.communicate(), timeout)
         output = stdout_b.decode()
         stderr = stderr_b.decode()
     except OSError as ex:
-        # failed to execute 'cmd' or '/bin/sh'
+        # failed to execute the CLI
         error = CredentialUnavailableError(message="Failed to execute '{}'".format(args[0]))
         raise error from ex
     except asyncio.TimeoutError as ex:
@@ -139,7 +178,7 @@ async def _run_command(command: str, timeout: int) -> str:
         return output
 
     # Fallback check in case the executable is not found while executing subprocess.
-    if proc.returncode == 127 or stderr.startswith("'az' is not recognized"):
+    if proc.returncode == 127:
         raise CredentialUnavailableError(CLI_NOT_FOUND)
 
     if "az login" in stderr or "az account set" in stderr:
@@ -4,11 +4,14 @@
 # ------------------------------------
 from datetime import datetime
 import json
-import re
+import threading
+import time
 
 from azure.identity import AzureDeveloperCliCredential, CredentialUnavailableError
 from azure.identity._constants import EnvironmentVariables
 from azure.identity._credentials.azd_cli import CLI_NOT_FOUND, NOT_LOGGED_IN
+from azure.identity._credentials import azd_cli
+from azure.identity._internal import cli_credential_base
 from azure.core.exceptions import ClientAuthenticationError
 
 import subprocess
@@ -16,7 +19,7 @@ import pytest
 
 from helpers import mock
 
-CHECK_OUTPUT = AzureDeveloperCliCredential.__module__ + ".subprocess.check_output"
+POPEN = cli_credential_base.__name__ + ".subprocess.Popen"
 
 TEST_ERROR_OUTPUTS = (
     '{"token": "secret value',
@@ -30,9 +33,17 @@ TEST_ERROR_OUTPUTS = (
 )
 
 
-def raise_called_process_error(return_code, output="", cmd="...", stderr=""):
-    error = subprocess.CalledProcessError(return_code, cmd=cmd, output=output, stderr=stderr)
-    return mock.Mock(side_effect=error)
+
+@pytest.fixture(autouse=True)
+def clear_executable_cache():
+    """_resolve_executable caches which() results; clear it so each test's shutil.which mock takes effect"""
+    cli_credential_base.resolve_executable.cache_clear()
+    yield
+
+def mock_popen(stdout="", stderr="", return_code=0):
+    # the real process produces bytes streams
+    process = mock.Mock(communicate=mock.Mock(return_value=(stdout.encode(), stderr.encode())), returncode=return_code)
+    return mock.Mock(return_value=process)
 
 
 def test_no_scopes():
@@ -49,7 +60,7 @@ def test_get_token():
     expected_expires_on = 1602015811
     successful_output = json.dumps(
         {
-            "expiresOn": datetime.fromtimestamp(expected_expires_on).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "expiresOn": datetime.utcfromtimestamp(expected_expires_on).strftime("%Y-%m-%dT%H:%M:%SZ"),
             "token": access_token,
             "subscription": "some-guid",
             "tenant": "some-guid",
@@ -58,7 +69,7 @@ def test_get_token():
     )
 
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(return_value=successful_output)):
+        with mock.patch(POPEN, mock_popen(successful_output)):
             token = AzureDeveloperCliCredential().get_token("scope")
 
     assert token.token == access_token
@@ -66,6 +77,125 @@ def test_get_token():
     assert token.expires_on == expected_expires_on
 
 
+def test_token_caching():
+    """The credential should invoke the CLI once per token when caching is enabled, and always when it isn't"""
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.utcfromtimestamp(time.time() + 1800).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "token": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    AzureDeveloperCliCredential._token_cache.clear()
+    with mock.patch("shutil.which", return_value="azd"):
+        with mock.patch(POPEN, mock_popen(successful_output)) as popen_mock:
+            # caching is opt-in: by default every get_token call invokes the CLI
+            credential = AzureDeveloperCliCredential()
+            credential.get_token("scope")
+            credential.get_token("scope")
+            assert popen_mock.call_count == 2
+
+            credential = AzureDeveloperCliCredential(enable_token_caching=True)
+            first_token = credential.get_token("scope")
+            second_token = credential.get_token("scope")
+            assert popen_mock.call_count == 3
+            assert second_token.token == first_token.token
+
+            # a different scope or tenant is a cache miss
+            credential.get_token("another scope")
+            assert popen_mock.call_count == 4
+    AzureDeveloperCliCredential._token_cache.clear()
+
+
+def test_persistent_token_caching(tmp_path):
+    """When configured with persistence options, the credential should share tokens across instances via a file"""
+
+    from msal_extensions import FilePersistence
+
+    from azure.identity import TokenCachePersistenceOptions
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.utcfromtimestamp(time.time() + 1800).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "token": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    persistence = FilePersistence(str(tmp_path / "azd.token-cache"))
+    options = TokenCachePersistenceOptions(allow_unencrypted_storage=True)
+    with mock.patch("azure.identity._internal.cli_token_cache._get_persistence", return_value=persistence):
+        with mock.patch("shutil.which", return_value="azd"):
+            with mock.patch(POPEN, mock_popen(successful_output)) as popen_mock:
+                first_token = AzureDeveloperCliCredential(cache_persistence_options=options).get_token("scope")
+                assert popen_mock.call_count == 1
+
+                # a new instance, as in a new process, should read the persisted token instead of invoking the CLI
+                second_token = AzureDeveloperCliCredential(cache_persistence_options=options).get_token("scope")
+                assert popen_mock.call_count == 1
+                assert second_token.token == first_token.token
+
+
+def test_concurrent_get_token_shares_one_invocation():
+    """Concurrent get_token calls for the same scopes should share a single CLI invocation"""
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.utcfromtimestamp(time.time() + 1800).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "token": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    release = threading.Event()
+    calls = []
+
+    def fake_popen(command_line, **_):
+        calls.append(command_line)
+        assert release.wait(10)
+        return mock.Mock(communicate=mock.Mock(return_value=(successful_output.encode(), b"")), returncode=0)
+
+    credential = AzureDeveloperCliCredential()
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(credential.get_token("scope"))) for _ in range(4)]
+    with mock.patch("shutil.which", return_value="azd"):
+        with mock.patch(POPEN, fake_popen):
+            for thread in threads:
+                thread.start()
+            while not calls:
+                time.sleep(0.01)
+            time.sleep(0.5)  # give the other threads time to join the in-flight request
+            release.set()
+            for thread in threads:
+                thread.join(10)
+
+    assert len(calls) == 1
+    assert len(tokens) == 4
+    assert all(token.token == "access token" for token in tokens)
+
+
+
+def test_waiting_get_token_timeout():
+    """A call waiting on another thread's CLI invocation should convert its timeout to CredentialUnavailableError"""
+
+    from concurrent.futures import Future
+
+    key = (("scope",), "", None)
+    never_resolved: Future = Future()
+    with mock.patch.dict(AzureDeveloperCliCredential._inflight, {key: never_resolved}, clear=True):
+        # process_timeout=-5 gives the waiter a zero-second wait on the shared future
+        with pytest.raises(CredentialUnavailableError):
+            AzureDeveloperCliCredential(process_timeout=-5).get_token("scope")
+
+
 def test_cli_not_installed():
     """The credential should raise CredentialUnavailableError when the CLI isn't installed"""
     with mock.patch("shutil.which", return_value=None):
@@ -77,7 +207,7 @@ def test_cannot_execute_shell():
     """The credential should raise CredentialUnavailableError when the subprocess doesn't start"""
 
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(side_effect=OSError())):
+        with mock.patch(POPEN, mock.Mock(side_effect=OSError())):
             with pytest.raises(CredentialUnavailableError):
                 AzureDeveloperCliCredential().get_token("scope")
 
@@ -87,7 +217,7 @@ def test_not_logged_in():
 
     stderr = "ERROR: not logged in, run `azd auth login` to login"
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, raise_called_process_error(1, stderr=stderr)):
+        with mock.patch(POPEN, mock_popen(stderr=stderr, return_code=1)):
             with pytest.raises(CredentialUnavailableError, match=NOT_LOGGED_IN):
                 AzureDeveloperCliCredential().get_token("scope")
 
@@ -97,7 +227,7 @@ def test_unexpected_error():
 
     stderr = "something went wrong"
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, raise_called_process_error(42, stderr=stderr)):
+        with mock.patch(POPEN, mock_popen(stderr=stderr, return_code=42)):
             with pytest.raises(ClientAuthenticationError, match=stderr):
                 AzureDeveloperCliCredential().get_token("scope")
 
@@ -107,7 +237,7 @@ def test_parsing_error_does_not_expose_token(output):
     """Errors during CLI output parsing shouldn't expose access tokens in that output"""
 
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(return_value=output)):
+        with mock.patch(POPEN, mock_popen(output)):
             with pytest.raises(ClientAuthenticationError) as ex:
                 AzureDeveloperCliCredential().get_token("scope")
 
@@ -120,7 +250,7 @@ def test_subprocess_error_does_not_expose_token(output):
     """Errors from the subprocess shouldn't expose access tokens in CLI output"""
 
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, raise_called_process_error(1, output=output)):
+        with mock.patch(POPEN, mock_popen(stdout=output, return_code=1)):
             with pytest.raises(ClientAuthenticationError) as ex:
                 AzureDeveloperCliCredential().get_token("scope")
 
@@ -131,17 +261,16 @@ def test_subprocess_error_does_not_expose_token(output):
 def test_timeout():
     """The credential should raise CredentialUnavailableError when the subprocess times out"""
 
-    from subprocess import TimeoutExpired
-
+    process = mock.Mock(communicate=mock.Mock(side_effect=subprocess.TimeoutExpired("", 42)), returncode=None)
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(side_effect=TimeoutExpired("", 42))) as check_output_mock:
+        with mock.patch(POPEN, mock.Mock(return_value=process)):
             with pytest.raises(CredentialUnavailableError):
                 AzureDeveloperCliCredential(process_timeout=42).get_token("scope")
 
-    # Ensure custom timeout is passed to subprocess
-    _, kwargs = check_output_mock.call_args
-    assert "timeout" in kwargs
-    assert kwargs["timeout"] == 42
+    # Ensure custom timeout is passed to subprocess, and the process is killed after it expires
+    _, kwargs = process.communicate.call_args
+    assert kwargs.get("timeout") == 42
+    assert process.kill.call_count == 1
 
 
 def test_multitenant_authentication_class():
@@ -150,22 +279,22 @@ def test_multitenant_authentication_class():
     second_tenant = "second-tenant"
     second_token = first_token * 2
 
-    def fake_check_output(command_line, **_):
-        match = re.search("--tenant-id (.*)", command_line[-1])
-        tenant = match.groups()[0] if match else default_tenant
+    def fake_popen(command_line, **_):
+        tenant = command_line[command_line.index("--tenant-id") + 1] if "--tenant-id" in command_line else default_tenant
         assert tenant in (default_tenant, second_tenant), 'unexpected tenant "{}"'.format(tenant)
-        return json.dumps(
+        output = json.dumps(
             {
-                "expiresOn": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "expiresOn": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
                 "token": first_token if tenant == default_tenant else second_token,
                 "subscription": "some-guid",
                 "tenant": tenant,
                 "tokenType": "Bearer",
             }
         )
+        return mock.Mock(communicate=mock.Mock(return_value=(output.encode(), b"")), returncode=0)
 
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, fake_check_output):
+        with mock.patch(POPEN, fake_popen):
             token = AzureDeveloperCliCredential().get_token("scope")
             assert token.token == first_token
 
@@ -181,23 +310,23 @@ def test_multitenant_authentication():
     second_tenant = "second-tenant"
     second_token = first_token * 2
 
-    def fake_check_output(command_line, **_):
-        match = re.search("--tenant-id (.*)", command_line[-1])
-        tenant = match.groups()[0] if match else default_tenant
+    def fake_popen(command_line, **_):
+        tenant = command_line[command_line.index("--tenant-id") + 1] if "--tenant-id" in command_line else default_tenant
         assert tenant in (default_tenant, second_tenant), 'unexpected tenant "{}"'.format(tenant)
-        return json.dumps(
+        output = json.dumps(
             {
-                "expiresOn": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "expiresOn": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
                 "token": first_token if tenant == default_tenant else second_token,
                 "subscription": "some-guid",
                 "tenant": tenant,
                 "tokenType": "Bearer",
             }
         )
+        return mock.Mock(communicate=mock.Mock(return_value=(output.encode(), b"")), returncode=0)
 
     credential = AzureDeveloperCliCredential()
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, fake_check_output):
+        with mock.patch(POPEN, fake_popen):
             token = credential.get_token("scope")
             assert token.token == first_token
 
@@ -215,22 +344,22 @@ def test_multitenant_authentication_not_allowed():
     expected_tenant = "expected-tenant"
     expected_token = "***"
 
-    def fake_check_output(command_line, **_):
-        match = re.search("--tenant-id (.*)", command_line[-1])
-        assert match is None or match[1] == expected_tenant
-        return json.dumps(
+    def fake_popen(command_line, **_):
+        assert "--tenant-id" not in command_line or command_line[command_line.index("--tenant-id") + 1] == expected_tenant
+        output = json.dumps(
             {
-                "expiresOn": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "expiresOn": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
                 "token": expected_token,
                 "subscription": "some-guid",
                 "tenant": expected_token,
                 "tokenType": "Bearer",
             }
         )
+        return mock.Mock(communicate=mock.Mock(return_value=(output.encode(), b"")), returncode=0)
 
     credential = AzureDeveloperCliCredential()
     with mock.patch("shutil.which", return_value="azd"):
-        with mock.patch(CHECK_OUTPUT, fake_check_output):
+        with mock.patch(POPEN, fake_popen):
             token = credential.get_token("scope")
             assert token.token == expected_token
 
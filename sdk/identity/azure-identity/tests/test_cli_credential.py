@@ -4,11 +4,14 @@
 # ------------------------------------
 from datetime import datetime
 import json
-import re
+import threading
+import time
 
 from azure.identity import AzureCliCredential, CredentialUnavailableError
 from azure.identity._constants import EnvironmentVariables
 from azure.identity._credentials.azure_cli import CLI_NOT_FOUND, NOT_LOGGED_IN
+from azure.identity._credentials import azure_cli
+from azure.identity._internal import cli_credential_base
 from azure.core.exceptions import ClientAuthenticationError
 
 import subprocess
@@ -16,7 +19,7 @@ import pytest
 
 from helpers import mock
 
-CHECK_OUTPUT = AzureCliCredential.__module__ + ".subprocess.check_output"
+POPEN = cli_credential_base.__name__ + ".subprocess.Popen"
 
 TEST_ERROR_OUTPUTS = (
     '{"accessToken": "secret value',
@@ -30,9 +33,17 @@ TEST_ERROR_OUTPUTS = (
 )
 
 
-def raise_called_process_error(return_code, output="", cmd="...", stderr=""):
-    error = subprocess.CalledProcessError(return_code, cmd=cmd, output=output, stderr=stderr)
-    return mock.Mock(side_effect=error)
+
+@pytest.fixture(autouse=True)
+def clear_executable_cache():
+    """_resolve_executable caches which() results; clear it so each test's shutil.which mock takes effect"""
+    cli_credential_base.resolve_executable.cache_clear()
+    yield
+
+def mock_popen(stdout="", stderr="", return_code=0):
+    # the real process produces bytes streams
+    process = mock.Mock(communicate=mock.Mock(return_value=(stdout.encode(), stderr.encode())), returncode=return_code)
+    return mock.Mock(return_value=process)
 
 
 def test_no_scopes():
@@ -65,7 +76,7 @@ def test_get_token():
     )
 
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(return_value=successful_output)):
+        with mock.patch(POPEN, mock_popen(successful_output)):
             token = AzureCliCredential().get_token("scope")
 
     assert token.token == access_token
@@ -73,6 +84,155 @@ def test_get_token():
     assert token.expires_on == expected_expires_on
 
 
+def test_token_caching():
+    """The credential should invoke the CLI once per token when caching is enabled, and always when it isn't"""
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.fromtimestamp(time.time() + 1800).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "accessToken": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    AzureCliCredential._token_cache.clear()
+    with mock.patch("shutil.which", return_value="az"):
+        with mock.patch(POPEN, mock_popen(successful_output)) as popen_mock:
+            # caching is opt-in: by default every get_token call invokes the CLI
+            credential = AzureCliCredential()
+            credential.get_token("scope")
+            credential.get_token("scope")
+            assert popen_mock.call_count == 2
+
+            credential = AzureCliCredential(enable_token_caching=True)
+            first_token = credential.get_token("scope")
+            second_token = credential.get_token("scope")
+            assert popen_mock.call_count == 3
+            assert second_token.token == first_token.token
+
+            # a different scope or tenant is a cache miss
+            credential.get_token("another scope")
+            assert popen_mock.call_count == 4
+    AzureCliCredential._token_cache.clear()
+
+
+def test_persistent_token_caching(tmp_path):
+    """When configured with persistence options, the credential should share tokens across instances via a file"""
+
+    from msal_extensions import FilePersistence
+
+    from azure.identity import TokenCachePersistenceOptions
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.fromtimestamp(time.time() + 1800).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "accessToken": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    persistence = FilePersistence(str(tmp_path / "az.token-cache"))
+    options = TokenCachePersistenceOptions(allow_unencrypted_storage=True)
+    with mock.patch("azure.identity._internal.cli_token_cache._get_persistence", return_value=persistence):
+        with mock.patch("shutil.which", return_value="az"):
+            with mock.patch(POPEN, mock_popen(successful_output)) as popen_mock:
+                first_token = AzureCliCredential(cache_persistence_options=options).get_token("scope")
+                assert popen_mock.call_count == 1
+
+                # a new instance, as in a new process, should read the persisted token instead of invoking the CLI
+                second_token = AzureCliCredential(cache_persistence_options=options).get_token("scope")
+                assert popen_mock.call_count == 1
+                assert second_token.token == first_token.token
+
+
+def test_persistent_token_caching_invalid_shape(tmp_path):
+    """A cache file holding valid JSON that isn't an object should be treated as a miss, not an error"""
+
+    from msal_extensions import FilePersistence
+
+    from azure.identity import TokenCachePersistenceOptions
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.fromtimestamp(time.time() + 1800).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "accessToken": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    cache_path = tmp_path / "az.token-cache"
+    cache_path.write_text(json.dumps(["not", "a", "cache"]))
+    persistence = FilePersistence(str(cache_path))
+    options = TokenCachePersistenceOptions(allow_unencrypted_storage=True)
+    with mock.patch("azure.identity._internal.cli_token_cache._get_persistence", return_value=persistence):
+        with mock.patch("shutil.which", return_value="az"):
+            with mock.patch(POPEN, mock_popen(successful_output)) as popen_mock:
+                token = AzureCliCredential(cache_persistence_options=options).get_token("scope")
+
+    assert popen_mock.call_count == 1
+    assert token.token == "access token"
+
+
+def test_concurrent_get_token_shares_one_invocation():
+    """Concurrent get_token calls for the same scopes should share a single CLI invocation"""
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.fromtimestamp(time.time() + 1800).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "accessToken": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    release = threading.Event()
+    calls = []
+
+    def fake_popen(command_line, **_):
+        calls.append(command_line)
+        assert release.wait(10)
+        return mock.Mock(communicate=mock.Mock(return_value=(successful_output.encode(), b"")), returncode=0)
+
+    credential = AzureCliCredential()
+    tokens = []
+    threads = [threading.Thread(target=lambda: tokens.append(credential.get_token("scope"))) for _ in range(4)]
+    with mock.patch("shutil.which", return_value="az"):
+        with mock.patch(POPEN, fake_popen):
+            for thread in threads:
+                thread.start()
+            while not calls:
+                time.sleep(0.01)
+            time.sleep(0.5)  # give the other threads time to join the in-flight request
+            release.set()
+            for thread in threads:
+                thread.join(10)
+
+    assert len(calls) == 1
+    assert len(tokens) == 4
+    assert all(token.token == "access token" for token in tokens)
+
+
+
+def test_waiting_get_token_timeout():
+    """A call waiting on another thread's CLI invocation should convert its timeout to CredentialUnavailableError"""
+
+    from concurrent.futures import Future
+
+    key = (("scope",), "", None)
+    never_resolved: Future = Future()
+    with mock.patch.dict(AzureCliCredential._inflight, {key: never_resolved}, clear=True):
+        # process_timeout=-5 gives the waiter a zero-second wait on the shared future
+        with pytest.raises(CredentialUnavailableError):
+            AzureCliCredential(process_timeout=-5).get_token("scope")
+
+
 def test_cli_not_installed():
     """The credential should raise CredentialUnavailableError when the CLI isn't installed"""
     with mock.patch("shutil.which", return_value=None):
@@ -84,7 +244,7 @@ def test_cannot_execute_shell():
     """The credential should raise CredentialUnavailableError when the subprocess doesn't start"""
 
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(side_effect=OSError())):
+        with mock.patch(POPEN, mock.Mock(side_effect=OSError())):
             with pytest.raises(CredentialUnavailableError):
                 AzureCliCredential().get_token("scope")
 
@@ -94,7 +254,7 @@ def test_not_logged_in():
 
     stderr = "ERROR: Please run 'az login' to setup account."
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, raise_called_process_error(1, stderr=stderr)):
+        with mock.patch(POPEN, mock_popen(stderr=stderr, return_code=1)):
             with pytest.raises(CredentialUnavailableError, match=NOT_LOGGED_IN):
                 AzureCliCredential().get_token("scope")
 
@@ -104,7 +264,7 @@ def test_unexpected_error():
 
     stderr = "something went wrong"
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, raise_called_process_error(42, stderr=stderr)):
+        with mock.patch(POPEN, mock_popen(stderr=stderr, return_code=42)):
             with pytest.raises(ClientAuthenticationError, match=stderr):
                 AzureCliCredential().get_token("scope")
 
@@ -114,7 +274,7 @@ def test_parsing_error_does_not_expose_token(output):
     """Errors during CLI output parsing shouldn't expose access tokens in that output"""
 
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(return_value=output)):
+        with mock.patch(POPEN, mock_popen(output)):
             with pytest.raises(ClientAuthenticationError) as ex:
                 AzureCliCredential().get_token("scope")
 
@@ -127,7 +287,7 @@ def test_subprocess_error_does_not_expose_token(output):
     """Errors from the subprocess shouldn't expose access tokens in CLI output"""
 
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, raise_called_process_error(1, output=output)):
+        with mock.patch(POPEN, mock_popen(stdout=output, return_code=1)):
             with pytest.raises(ClientAuthenticationError) as ex:
                 AzureCliCredential().get_token("scope")
 
@@ -138,17 +298,16 @@ def test_subprocess_error_does_not_expose_token(output):
 def test_timeout():
     """The credential should raise CredentialUnavailableError when the subprocess times out"""
 
-    from subprocess import TimeoutExpired
-
+    process = mock.Mock(communicate=mock.Mock(side_effect=subprocess.TimeoutExpired("", 42)), returncode=None)
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, mock.Mock(side_effect=TimeoutExpired("", 42))) as check_output_mock:
+        with mock.patch(POPEN, mock.Mock(return_value=process)):
             with pytest.raises(CredentialUnavailableError):
                 AzureCliCredential(process_timeout=42).get_token("scope")
 
-    # Ensure custom timeout is passed to subprocess
-    _, kwargs = check_output_mock.call_args
-    assert "timeout" in kwargs
-    assert kwargs["timeout"] == 42
+    # Ensure custom timeout is passed to subprocess, and the process is killed after it expires
+    _, kwargs = process.communicate.call_args
+    assert kwargs.get("timeout") == 42
+    assert process.kill.call_count == 1
 
 
 def test_multitenant_authentication_class():
@@ -157,11 +316,10 @@ def test_multitenant_authentication_class():
     second_tenant = "second-tenant"
     second_token = first_token * 2
 
-    def fake_check_output(command_line, **_):
-        match = re.search("--tenant (.*)", command_line[-1])
-        tenant = match.groups()[0] if match else default_tenant
+    def fake_popen(command_line, **_):
+        tenant = command_line[command_line.index("--tenant") + 1] if "--tenant" in command_line else default_tenant
         assert tenant in (default_tenant, second_tenant), 'unexpected tenant "{}"'.format(tenant)
-        return json.dumps(
+        output = json.dumps(
             {
                 "expiresOn": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
                 "accessToken": first_token if tenant == default_tenant else second_token,
@@ -170,9 +328,10 @@ def test_multitenant_authentication_class():
                 "tokenType": "Bearer",
             }
         )
+        return mock.Mock(communicate=mock.Mock(return_value=(output.encode(), b"")), returncode=0)
 
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, fake_check_output):
+        with mock.patch(POPEN, fake_popen):
             token = AzureCliCredential().get_token("scope")
             assert token.token == first_token
 
@@ -189,11 +348,10 @@ def test_multitenant_authentication():
     second_tenant = "second-tenant"
     second_token = first_token * 2
 
-    def fake_check_output(command_line, **_):
-        match = re.search("--tenant (.*)", command_line[-1])
-        tenant = match.groups()[0] if match else default_tenant
+    def fake_popen(command_line, **_):
+        tenant = command_line[command_line.index("--tenant") + 1] if "--tenant" in command_line else default_tenant
         assert tenant in (default_tenant, second_tenant), 'unexpected tenant "{}"'.format(tenant)
-        return json.dumps(
+        output = json.dumps(
             {
                 "expiresOn": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
                 "accessToken": first_token if tenant == default_tenant else second_token,
@@ -202,10 +360,11 @@ def test_multitenant_authentication():
                 "tokenType": "Bearer",
             }
         )
+        return mock.Mock(communicate=mock.Mock(return_value=(output.encode(), b"")), returncode=0)
 
     credential = AzureCliCredential()
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, fake_check_output):
+        with mock.patch(POPEN, fake_popen):
             token = credential.get_token("scope")
             assert token.token == first_token
 
@@ -224,10 +383,9 @@ def test_multitenant_authentication_not_allowed():
     expected_tenant = "expected-tenant"
     expected_token = "***"
 
-    def fake_check_output(command_line, **_):
-        match = re.search("--tenant (.*)", command_line[-1])
-        assert match is None or match[1] == expected_tenant
-        return json.dumps(
+    def fake_popen(command_line, **_):
+        assert "--tenant" not in command_line or command_line[command_line.index("--tenant") + 1] == expected_tenant
+        output = json.dumps(
             {
                 "expiresOn": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
                 "accessToken": expected_token,
@@ -236,10 +394,11 @@ def test_multitenant_authentication_not_allowed():
                 "tokenType": "Bearer",
             }
         )
+        return mock.Mock(communicate=mock.Mock(return_value=(output.encode(), b"")), returncode=0)
 
     credential = AzureCliCredential()
     with mock.patch("shutil.which", return_value="az"):
-        with mock.patch(CHECK_OUTPUT, fake_check_output):
+        with mock.patch(POPEN, fake_popen):
             token = credential.get_token("scope")
             assert token.token == expected_token
 
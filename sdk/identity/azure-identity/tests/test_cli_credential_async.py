@@ -5,7 +5,6 @@
 import asyncio
 from datetime import datetime
 import json
-import re
 import sys
 from unittest import mock
 
@@ -13,6 +12,8 @@ from azure.identity import CredentialUnavailableError
 from azure.identity.aio import AzureCliCredential
 from azure.identity._constants import EnvironmentVariables
 from azure.identity._credentials.azure_cli import CLI_NOT_FOUND, NOT_LOGGED_IN
+from azure.identity._credentials import azure_cli
+from azure.identity._internal import cli_credential_base
 from azure.core.exceptions import ClientAuthenticationError
 import pytest
 
@@ -24,6 +25,13 @@ SUBPROCESS_EXEC = AzureCliCredential.__module__ + ".asyncio.create_subprocess_ex
 pytestmark = pytest.mark.asyncio
 
 
+
+@pytest.fixture(autouse=True)
+def clear_executable_cache():
+    """_resolve_executable caches which() results; clear it so each test's shutil.which mock takes effect"""
+    cli_credential_base.resolve_executable.cache_clear()
+    yield
+
 def mock_exec(stdout, stderr="", return_code=0):
     async def communicate():
         return (stdout.encode(), stderr.encode())
@@ -186,8 +194,7 @@ async def test_multitenant_authentication():
     second_token = first_token * 2
 
     async def fake_exec(*args, **_):
-        match = re.search("--tenant (.*)", args[-1])
-        tenant = match[1] if match else default_tenant
+        tenant = args[args.index("--tenant") + 1] if "--tenant" in args else default_tenant
         assert tenant in (default_tenant, second_tenant), 'unexpected tenant "{}"'.format(tenant)
         output = json.dumps(
             {
@@ -221,8 +228,7 @@ async def test_multitenant_authentication_not_allowed():
     expected_token = "***"
 
     async def fake_exec(*args, **_):
-        match = re.search("--tenant (.*)", args[-1])
-        assert match is None or match[1] == expected_tenant
+        assert "--tenant" not in args or args[args.index("--tenant") + 1] == expected_tenant
         output = json.dumps(
             {
                 "expiresOn": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"),
@@ -243,3 +249,89 @@ async def test_multitenant_authentication_not_allowed():
             with mock.patch.dict("os.environ", {EnvironmentVariables.AZURE_IDENTITY_DISABLE_MULTITENANTAUTH: "true"}):
                 token = await credential.get_token("scope", tenant_id="un" + expected_tenant)
             assert token.token == expected_token
+
+
+async def test_concurrent_get_token_shares_one_invocation():
+    """Concurrent get_token calls for the same scopes should share a single CLI invocation"""
+
+    import time
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.fromtimestamp(time.time() + 1800).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "accessToken": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    release = asyncio.Event()
+    calls = []
+
+    def fake_exec(*args, **_):
+        calls.append(args)
+
+        async def communicate():
+            await release.wait()
+            return (successful_output.encode(), b"")
+
+        process = mock.Mock(communicate=communicate, returncode=0)
+        return get_completed_future(process)
+
+    credential = AzureCliCredential()
+    with mock.patch("shutil.which", return_value="az"):
+        with mock.patch(SUBPROCESS_EXEC, fake_exec):
+            tasks = [asyncio.ensure_future(credential.get_token("scope")) for _ in range(4)]
+            await asyncio.sleep(0.1)  # give the other tasks time to join the in-flight request
+            release.set()
+            tokens = await asyncio.gather(*tasks)
+
+    assert len(calls) == 1
+    assert len(tokens) == 4
+    assert all(token.token == "access token" for token in tokens)
+
+
+async def test_cancelled_task_does_not_cancel_waiters():
+    """Cancelling the task that owns the CLI invocation shouldn't cancel other tasks awaiting its result"""
+
+    import time
+
+    successful_output = json.dumps(
+        {
+            "expiresOn": datetime.fromtimestamp(time.time() + 1800).strftime("%Y-%m-%d %H:%M:%S.%f"),
+            "accessToken": "access token",
+            "subscription": "some-guid",
+            "tenant": "some-guid",
+            "tokenType": "Bearer",
+        }
+    )
+
+    release = asyncio.Event()
+    calls = []
+
+    def fake_exec(*args, **_):
+        calls.append(args)
+
+        async def communicate():
+            await release.wait()
+            return (successful_output.encode(), b"")
+
+        process = mock.Mock(communicate=communicate, returncode=0)
+        return get_completed_future(process)
+
+    credential = AzureCliCredential()
+    with mock.patch("shutil.which", return_value="az"):
+        with mock.patch(SUBPROCESS_EXEC, fake_exec):
+            leader = asyncio.ensure_future(credential.get_token("scope"))
+            await asyncio.sleep(0.1)  # let the leading task spawn the CLI
+            waiter = asyncio.ensure_future(credential.get_token("scope"))
+            await asyncio.sleep(0.1)  # let the waiter join the in-flight request
+            leader.cancel()
+            await asyncio.sleep(0.1)  # let the waiter fall back to an invocation of its own
+            release.set()
+            token = await waiter
+
+    assert leader.cancelled()
+    assert token.token == "access token"
+    assert len(calls) == 2